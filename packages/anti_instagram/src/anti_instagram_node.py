@@ -1,9 +1,12 @@
 #!/usr/bin/env python3
 
+import queue
+from threading import Thread
+
+import cv2
+import numpy as np
 import rospy
-from multiprocessing import Lock
 from image_processing.anti_instagram import AntiInstagram
-from cv_bridge import CvBridge
 from sensor_msgs.msg import CompressedImage
 from duckietown_msgs.msg import AntiInstagramThresholds
 
@@ -33,6 +36,21 @@ class AntiInstagramNode(DTROS):
         self._color_balance_percentage = rospy.get_param("~color_balance_scale")
         self._output_scale = rospy.get_param("~output_scale")
 
+        # let the JPEG decoder downscale the image as much as the output scale allows, it is almost for
+        # free there, what is left of the scaling is done by AntiInstagram
+        self._decode_flag = cv2.IMREAD_COLOR
+        self._resize_scale = self._output_scale
+        reduced_flags = (
+            (8, cv2.IMREAD_REDUCED_COLOR_8),
+            (4, cv2.IMREAD_REDUCED_COLOR_4),
+            (2, cv2.IMREAD_REDUCED_COLOR_2),
+        )
+        for factor, flag in reduced_flags:
+            if self._output_scale * factor <= 1:
+                self._decode_flag = flag
+                self._resize_scale = self._output_scale * factor
+                break
+
         # Construct publisher
         self.pub = rospy.Publisher(
             "~thresholds", AntiInstagramThresholds, queue_size=1, dt_topic_type=TopicType.PERCEPTION
@@ -47,44 +65,73 @@ class AntiInstagramNode(DTROS):
             queue_size=1,
         )
 
-        # Initialize Timer
-        rospy.Timer(rospy.Duration(self._interval), self.calculate_new_parameters)
-
         # Initialize objects and data
         self.ai = AntiInstagram()
-        self.bridge = CvBridge()
+        # only ever swapped as a whole by store_image_msg, which is atomic and needs no lock
         self.image_msg = None
-        self.mutex = Lock()
+        # last image handed to the worker, store_image_msg always stores a new object
+        self._last_image_msg = None
+
+        # the thresholds are computed on a worker thread so that the timer callback never blocks,
+        # the queue holds at most the next image to process
+        self._work_q = queue.Queue(maxsize=1)
+        Thread(target=self._worker, daemon=True).start()
+
+        # Initialize Timer
+        rospy.Timer(rospy.Duration(self._interval), self.calculate_new_parameters)
 
         # ---
         self.log("Initialized.")
 
     def store_image_msg(self, image_msg):
-        with self.mutex:
-            self.image_msg = image_msg
-
-    def decode_image_msg(self):
-        with self.mutex:
-            try:
-                image = self.bridge.compressed_imgmsg_to_cv2(self.image_msg, "bgr8")
-            except ValueError as e:
-                self.log(f"Anti_instagram cannot decode image: {e}")
+        self.image_msg = image_msg
+
+    def decode_image_msg(self, image_msg):
+        # cv2.imdecode raises on an empty buffer instead of returning None
+        if not image_msg.data:
+            self.log("Anti_instagram received an empty image", "warn")
+            return None
+        # decode the JPEG buffer in place, without the extra copy done by CvBridge
+        image = cv2.imdecode(np.frombuffer(image_msg.data, np.uint8), self._decode_flag)
+        if image is None:
+            self.log("Anti_instagram cannot decode image", "warn")
         return image
 
     def calculate_new_parameters(self, event):
-        if self.image_msg is None:
+        # take a reference first, the subscriber thread can replace self.image_msg at any time
+        image_msg = self.image_msg
+        if image_msg is None:
             self.log("Waiting for first image!")
             return
-        image = self.decode_image_msg()
-        (lower_thresholds, higher_thresholds) = self.ai.calculate_color_balance_thresholds(
-            image, self._output_scale, self._color_balance_percentage
-        )
+        # no new image since the last tick, the thresholds would not change
+        if image_msg is self._last_image_msg:
+            return
+        # hand the image over to the worker, skip this tick if an image is already waiting
+        try:
+            self._work_q.put_nowait(image_msg)
+        except queue.Full:
+            return
+        self._last_image_msg = image_msg
 
-        # Publish parameters
-        msg = AntiInstagramThresholds()
-        msg.low = lower_thresholds
-        msg.high = higher_thresholds
-        self.pub.publish(msg)
+    def _worker(self):
+        while not self.is_shutdown:
+            image_msg = self._work_q.get()
+            # an exception must not kill the thread, or thresholds would silently stop being published
+            try:
+                image = self.decode_image_msg(image_msg)
+                if image is None:
+                    continue
+                (lower_thresholds, higher_thresholds) = self.ai.calculate_color_balance_thresholds(
+                    np.ascontiguousarray(image), self._resize_scale, self._color_balance_percentage
+                )
+
+                # Publish parameters
+                msg = AntiInstagramThresholds()
+                msg.low = lower_thresholds
+                msg.high = higher_thresholds
+                self.pub.publish(msg)
+            except Exception as e:
+                self.logerr(f"Anti_instagram cannot compute new thresholds: {e}")
 
 
 if __name__ == "__main__":
@@ -10,30 +10,33 @@ class AntiInstagram:
     def __init__(self):
 
         self.higher_threshold = [255, 255, 255]
+        # scratch buffer for the low thresholds, only the copies made from it are returned
+        self._lower_threshold = np.zeros(3, dtype=np.uint8)
+        # offsets that put the values of the three channels in disjoint bins of a single histogram
+        self._channel_offsets = np.arange(3, dtype=np.intp) * 256
 
     def calculate_color_balance_thresholds(self, image, scale, percentage):
 
-        resized_image = cv2.resize(image, (0, 0), fx=scale, fy=scale)
+        if scale == 1:
+            resized_image = image
+        else:
+            resized_image = cv2.resize(image, (0, 0), fx=scale, fy=scale)
         H = resized_image.shape[0]
         cropped_image = resized_image[int(H * 0.3) : (H - 1), :, :]
 
         half_percent = percentage / 2
-        channels = cv2.split(cropped_image)
-
-        lower_threshold = []
-        for idx, channel in enumerate(channels):
-            # find the low and high precentile values (based on the input percentile)
-            height, width = channel.shape
-            num_pixels = width * height
-            flattened = channel.reshape(num_pixels)
+        pixels = np.ascontiguousarray(cropped_image).reshape((-1, 3))
+        num_pixels = pixels.shape[0]
 
-            # sort entries
-            flattened = np.sort(flattened)
+        # histogram of the three channels at once
+        hist = np.bincount((pixels + self._channel_offsets).ravel(), minlength=3 * 256).reshape((3, 256))
 
-            # calculate thresholds
-            lower_threshold.append(flattened[int(math.floor(num_pixels * half_percent))])
+        # find the low precentile value (based on the input percentile), i.e. the value that would be at
+        # the given index if the channel were sorted
+        index = int(math.floor(num_pixels * half_percent))
+        np.sum(np.cumsum(hist, axis=1) <= index, axis=1, out=self._lower_threshold)
 
-        return lower_threshold, self.higher_threshold
+        return self._lower_threshold.tolist(), list(self.higher_threshold)
 
     def apply_color_balance(self, lower_threshold, higher_threshold, image, scale=1):
 
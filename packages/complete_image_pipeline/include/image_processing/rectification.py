@@ -23,16 +23,39 @@ class Rectify:
     rmapx: np.ndarray
     rmapy: np.ndarray
 
+    K: np.ndarray
+    D: np.ndarray
+    R: np.ndarray
+    P: np.ndarray
+
     def __init__(self, camera_info: CameraInfo):
         self.ci = camera_info
         self.pcm = PinholeCameraModel()
         self.pcm.fromCameraInfo(self.ci)
         self._rectify_inited = False
         self._distort_inited = False
+        # the intrinsics never change, keep plain arrays built straight from the message around for cv2
+        self.K = np.asarray(camera_info.K, np.float64).reshape((3, 3))
+        self.D = np.asarray(camera_info.D, np.float64)
+        self.R = np.asarray(camera_info.R, np.float64).reshape((3, 3))
+        self.P = np.asarray(camera_info.P, np.float64).reshape((3, 4))
 
     def rectify_point(self, pixel: Point) -> Point:
-        p = (pixel.x, pixel.y)
-        return Point(*list(self.pcm.rectifyPoint(p)))
+        p = np.array([[[pixel.x, pixel.y]]], np.float64)
+        x, y = self.rectify_points(p)[0]
+        return Point(x, y)
+
+    def rectify_points(self, pixels: np.ndarray) -> np.ndarray:
+        """Rectify an array of pixels with a single call to :py:func:`cv2.undistortPoints`.
+
+        Args:
+            pixels (``np.ndarray``): ``(N, 2)`` or ``(N, 1, 2)`` pixel coordinates in the raw image
+
+        Returns:
+            ``np.ndarray``: ``(N, 2)`` pixel coordinates in the rectified image
+        """
+        src = pixels.reshape((-1, 1, 2))
+        return cv2.undistortPoints(src, self.K, self.D, R=self.R, P=self.P).reshape((-1, 2))
 
     def _init_rectify_maps(self):
         W = self.pcm.width
@@ -40,7 +63,7 @@ class Rectify:
         mapx = np.ndarray(shape=(H, W, 1), dtype="float32")
         mapy = np.ndarray(shape=(H, W, 1), dtype="float32")
         mapx, mapy = cv2.initUndistortRectifyMap(
-            self.pcm.K, self.pcm.D, self.pcm.R, self.pcm.P, (W, H), cv2.CV_32FC1, mapx, mapy
+            self.K, self.D, self.R, self.P, (W, H), cv2.CV_32FC1, mapx, mapy
         )
         self.mapx = mapx
         self.mapy = mapy
@@ -8,14 +8,44 @@ import numpy as np
 import yaml
 
 import rospy
-from cv_bridge import CvBridge
 from duckietown.dtros import DTROS, NodeType, TopicType
 from duckietown_msgs.msg import Segment, SegmentList
 from geometry_msgs.msg import Point as PointMsg
-from image_processing.ground_projection_geometry import GroundProjectionGeometry, Point
+from image_processing.ground_projection_geometry import GroundProjectionGeometry
 from image_processing.rectification import Rectify
 from sensor_msgs.msg import CameraInfo, CompressedImage
 
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+# JPEG quality of the debug image, lower than the default since it is only meant for visualization
+DEBUG_JPEG_QUALITY = 60
+
+
+def _load_homography(cali_file: str) -> np.ndarray:
+    """
+    Parses the homography matrix from an extrinsic calibration file with the C YAML loader, if available.
+
+    Args:
+        cali_file (:obj:`str`): path to the extrinsic calibration file
+
+    Returns:
+        :obj:`numpy array`: the 3x3 homography matrix
+
+    Raises:
+        ValueError: If the file does not contain exactly 9 homography values
+
+    """
+    with open(cali_file, "r") as stream:
+        calib_data = yaml.load(stream, Loader=YamlLoader)
+    # the homography is stored as a flat list of 9 floats, in row-major order
+    values = calib_data["homography"]
+    if len(values) != 9:
+        raise ValueError(f"Expected 9 homography values in {cali_file}, found {len(values)}")
+    return np.fromiter(values, dtype=np.float64, count=9).reshape((3, 3))
+
 
 class GroundProjectionNode(DTROS):
     """
@@ -42,7 +72,6 @@ class GroundProjectionNode(DTROS):
         calibration is accurate.
     """
 
-    bridge: CvBridge
     ground_projector: Optional[GroundProjectionGeometry]
     rectifier: Optional[Rectify]
 
@@ -50,7 +79,6 @@ class GroundProjectionNode(DTROS):
         # Initialize the DTROS parent class
         super(GroundProjectionNode, self).__init__(node_name=node_name, node_type=NodeType.PERCEPTION)
 
-        self.bridge = CvBridge()
         self.ground_projector = None
         self.rectifier = None
         self.homography = self.load_extrinsics()
@@ -74,9 +102,17 @@ class GroundProjectionNode(DTROS):
             dt_topic_type=TopicType.DEBUG,
         )
 
-        self.bridge = CvBridge()
+        # output segments reused across callbacks, publish() serializes them before returning
+        self._seg_pool = []
 
         self.debug_img_bg = None
+        # reused by every call to debug_image, the image is encoded before the next callback runs
+        self._debug_scratch = np.empty((400, 400, 3), np.uint8)
+        # map segment color variables (uint8) to BGR colors, unknown colors are black
+        self._color_lut = [(0, 0, 0)] * 256
+        self._color_lut[Segment.WHITE] = (255, 255, 255)
+        self._color_lut[Segment.RED] = (0, 0, 255)
+        self._color_lut[Segment.YELLOW] = (0, 255, 255)
 
         # Seems to be never used:
         # self.service_homog_ = rospy.Service("~estimate_homography", EstimateHomography,
@@ -98,16 +134,17 @@ class GroundProjectionNode(DTROS):
         if not self.camera_info_received:
             self.rectifier = Rectify(msg)
             self.ground_projector = GroundProjectionGeometry(
-                im_width=msg.width, im_height=msg.height, homography=np.array(self.homography).reshape((3, 3))
+                im_width=msg.width, im_height=msg.height, homography=self.homography
             )
+            # cache the matrices used by the batched projection in :py:meth:`lineseglist_cb`
+            self._H = self.homography.astype(np.float64, copy=False)
+            self._im_size = np.array([msg.width, msg.height], np.float64)
         self.camera_info_received = True
 
     def pixel_msg_to_ground_msg(self, point_msg) -> PointMsg:
         """
-        Creates a :py:class:`ground_projection.Point` object from a normalized point message from an
-        unrectified
-        image. It converts it to pixel coordinates and rectifies it. Then projects it to the ground plane and
-        converts it to a ROS Point message.
+        Projects a normalized point message from an unrectified image to the ground plane and converts it
+        to a ROS Point message. Single point version of :py:meth:`pixels_to_ground`.
 
         Args:
             point_msg (:obj:`geometry_msgs.msg.Point`): Normalized point coordinates from an unrectified
@@ -117,27 +154,39 @@ class GroundProjectionNode(DTROS):
             :obj:`geometry_msgs.msg.Point`: Point coordinates in the ground reference frame.
 
         """
-        # normalized coordinates to pixel:
-        norm_pt = Point.from_message(point_msg)
-        pixel = self.ground_projector.vector2pixel(norm_pt)
-        # rectify
-        rect = self.rectifier.rectify_point(pixel)
-        # convert to Point
-        rect_pt = Point.from_message(rect)
-        # project on ground
-        ground_pt = self.ground_projector.pixel2ground(rect_pt)
+        ground = self.pixels_to_ground(np.array([[point_msg.x, point_msg.y]], np.float64))
         # point to message
         ground_pt_msg = PointMsg()
-        ground_pt_msg.x = ground_pt.x
-        ground_pt_msg.y = ground_pt.y
-        ground_pt_msg.z = ground_pt.z
+        ground_pt_msg.x = ground[0, 0]
+        ground_pt_msg.y = ground[0, 1]
 
         return ground_pt_msg
 
+    def pixels_to_ground(self, pts: np.ndarray) -> np.ndarray:
+        """
+        Converts an array of normalized points from an unrectified image to pixel coordinates, rectifies
+        them all at once with :py:meth:`image_processing.Rectify.rectify_points` and projects them on the
+        ground plane with the homography matrix.
+
+        Args:
+            pts (:obj:`numpy array`): ``(N, 2)`` normalized point coordinates from an unrectified image.
+
+        Returns:
+            :obj:`numpy array`: ``(N, 2)`` point coordinates in the ground reference frame.
+
+        """
+        # normalized coordinates to pixel:
+        pixels = (pts * self._im_size).reshape((-1, 1, 2))
+        # rectify
+        rect = self.rectifier.rectify_points(pixels)
+        # project on ground
+        ground = rect @ self._H[:, :2].T + self._H[:, 2]
+        return ground[:, :2] / ground[:, 2:]
+
     def lineseglist_cb(self, seglist_msg):
         """
-        Projects a list of line segments on the ground reference frame point by point by
-        calling :py:meth:`pixel_msg_to_ground_msg`. Then publishes the projected list of segments.
+        Projects a list of line segments on the ground reference frame all at once by
+        calling :py:meth:`pixels_to_ground`. Then publishes the projected list of segments.
 
         Args:
             seglist_msg (:obj:`duckietown_msgs.msg.SegmentList`): Line segments in pixel space from
@@ -145,25 +194,57 @@ class GroundProjectionNode(DTROS):
 
         """
         if self.camera_info_received:
+            publish_segments = self.pub_lineseglist.get_num_connections() > 0
+            publish_debug = self.pub_debug_img.get_num_connections() > 0
+            # nobody needs the projected segments
+            if not (publish_segments or publish_debug):
+                return
+
             seglist_out = SegmentList()
             seglist_out.header = seglist_msg.header
-            for received_segment in seglist_msg.segments:
-                new_segment = Segment()
-                new_segment.points[0] = self.pixel_msg_to_ground_msg(received_segment.pixels_normalized[0])
-                new_segment.points[1] = self.pixel_msg_to_ground_msg(received_segment.pixels_normalized[1])
-                new_segment.color = received_segment.color
-                # TODO what about normal and points
-                seglist_out.segments.append(new_segment)
-            self.pub_lineseglist.publish(seglist_out)
-
-            if not self.first_processing_done:
-                self.log("First projected segments published.")
-                self.first_processing_done = True
-
-            if self.pub_debug_img.get_num_connections() > 0:
-                debug_image_msg = self.bridge.cv2_to_compressed_imgmsg(self.debug_image(seglist_out))
-                debug_image_msg.header = seglist_out.header
-                self.pub_debug_img.publish(debug_image_msg)
+            if seglist_msg.segments:
+                # pack the two endpoints of every segment in a (2N, 2) array
+                pts = np.array(
+                    [(p.x, p.y) for segment in seglist_msg.segments for p in segment.pixels_normalized],
+                    np.float64,
+                )
+                # plain floats are cheaper to index than numpy scalars
+                ground = self.pixels_to_ground(pts).tolist()
+                # grow the pool of output segments to the largest list seen so far
+                num_segments = len(seglist_msg.segments)
+                while len(self._seg_pool) < num_segments:
+                    self._seg_pool.append(Segment())
+                seglist_out.segments = self._seg_pool[:num_segments]
+                for received_segment, new_segment, g0, g1 in zip(
+                    seglist_msg.segments, seglist_out.segments, ground[0::2], ground[1::2]
+                ):
+                    # only the points and the color are ever written, z stays 0
+                    p0, p1 = new_segment.points
+                    p0.x, p0.y = g0
+                    p1.x, p1.y = g1
+                    new_segment.color = received_segment.color
+                    # TODO what about normal and points
+            # empty lists are published too, the lane filter runs its prediction step on every message
+            if publish_segments:
+                self.pub_lineseglist.publish(seglist_out)
+
+                if not self.first_processing_done:
+                    self.log("First projected segments published.")
+                    self.first_processing_done = True
+
+            # only draw and encode the debug image if somebody is listening
+            if publish_debug:
+                encoded, debug_image_buf = cv2.imencode(
+                    ".jpg", self.debug_image(seglist_out), [cv2.IMWRITE_JPEG_QUALITY, DEBUG_JPEG_QUALITY]
+                )
+                if encoded:
+                    debug_image_msg = CompressedImage()
+                    debug_image_msg.header = seglist_out.header
+                    debug_image_msg.format = "jpeg"
+                    debug_image_msg.data = debug_image_buf.tobytes()
+                    self.pub_debug_img.publish(debug_image_msg)
+                else:
+                    self.log("Could not encode the debug image", "warn")
         else:
             self.log("Waiting for a CameraInfo message", "warn")
 
@@ -212,15 +293,12 @@ class GroundProjectionNode(DTROS):
             rospy.signal_shutdown(msg)
 
         try:
-            with open(cali_file, "r") as stream:
-                calib_data = yaml.load(stream, Loader=yaml.Loader)
-        except yaml.YAMLError:
+            return _load_homography(cali_file)
+        except (yaml.YAMLError, ValueError):
             msg = f"Error in parsing calibration file {cali_file} ... aborting"
             self.logerr(msg)
             rospy.signal_shutdown(msg)
 
-        return calib_data["homography"]
-
     def debug_image(self, seg_list):
         """
         Generates a debug image with all the projected segments plotted with respect to the robot's origin.
@@ -242,11 +320,8 @@ class GroundProjectionNode(DTROS):
             # initialize gray image
             self.debug_img_bg = np.ones((400, 400, 3), np.uint8) * 128
 
-            # draw vertical lines of the grid
-            for vline in np.arange(40, 361, 40):
-                cv2.line(
-                    self.debug_img_bg, pt1=(vline, 20), pt2=(vline, 300), color=(255, 255, 0), thickness=1
-                )
+            # draw vertical lines of the grid, every 40px from x=40 to x=360, between y=20 and y=300
+            self.debug_img_bg[20:301, 40:361:40] = (255, 255, 0)
 
             # draw the coordinates
             cv2.putText(
@@ -277,11 +352,8 @@ class GroundProjectionNode(DTROS):
                 1,
             )
 
-            # draw horizontal lines of the grid
-            for hline in np.arange(20, 301, 40):
-                cv2.line(
-                    self.debug_img_bg, pt1=(40, hline), pt2=(360, hline), color=(255, 255, 0), thickness=1
-                )
+            # draw horizontal lines of the grid, every 40px from y=20 to y=300, between x=40 and x=360
+            self.debug_img_bg[20:301:40, 40:361] = (255, 255, 0)
 
             # draw the coordinates
             cv2.putText(
@@ -316,24 +388,33 @@ class GroundProjectionNode(DTROS):
                 thickness=1,
             )
 
-        # map segment color variables to BGR colors
-        color_map = {Segment.WHITE: (255, 255, 255), Segment.RED: (0, 0, 255), Segment.YELLOW: (0, 255, 255)}
+        np.copyto(self._debug_scratch, self.debug_img_bg)
+        image = self._debug_scratch
 
-        image = self.debug_img_bg.copy()
+        if not seg_list.segments:
+            return image
+
+        # (N, 2, 2) array with the endpoints of every segment, and their colors
+        points = np.array([[(p.x, p.y) for p in segment.points] for segment in seg_list.segments], np.float64)
+        colors = np.array([segment.color for segment in seg_list.segments])
 
         # plot every segment if both ends are in the scope of the image (within 50cm from the origin)
-        for segment in seg_list.segments:
-            if not np.any(
-                np.abs([segment.points[0].x, segment.points[0].y, segment.points[1].x, segment.points[1].y])
-                > 0.50
-            ):
-                cv2.line(
-                    image,
-                    pt1=(int(segment.points[0].y * -400) + 200, int(segment.points[0].x * -400) + 300),
-                    pt2=(int(segment.points[1].y * -400) + 200, int(segment.points[1].x * -400) + 300),
-                    color=color_map.get(segment.color, (0, 0, 0)),
-                    thickness=1,
-                )
+        in_scope = np.all(np.abs(points) <= 0.50, axis=(1, 2))
+        points = points[in_scope]
+        colors = colors[in_scope]
+
+        # ground coordinates to pixels, the image u axis is the ground -y axis and v is -x
+        pixels = (points[:, :, ::-1] * -400).astype(np.int32) + np.array([200, 300], np.int32)
+
+        # draw all the segments of the same color at once
+        for color in np.unique(colors):
+            cv2.polylines(
+                image,
+                pixels[colors == color],
+                isClosed=False,
+                color=self._color_lut[color],
+                thickness=1,
+            )
 
         return image
 